@@ -1,22 +1,52 @@
-from datetime import datetime, timedelta
 from typing import Optional, Dict, Any
-from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from config import settings
+
+# JWT后端选择：PyJWT的HS256签名/验证走原生代码，比python-jose的纯Python实现快
+if settings.jwt_use_pyjwt:
+    import jwt
+    JWTError = jwt.InvalidTokenError
+else:
+    from jose import JWTError, jwt
 from database import db_client
+from utils import iso_now
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
 import logging
-import uuid
+import secrets
+import time
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 已验证token的进程内缓存: token -> (payload, 过期时间戳)
+# 避免每个请求都重复执行base64/JSON/HMAC解码
+_token_cache: Dict[str, tuple] = {}
+_TOKEN_CACHE_TTL_SECONDS = 300
+_TOKEN_CACHE_SWEEP_INTERVAL = 512
+
 # 密码加密上下文
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# 成本因子可配置（默认10），并固定2b标识以便passlib直接分发到原生bcrypt后端
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=settings.bcrypt_rounds,
+    bcrypt__ident="2b",
+)
+
+def _b64url(data: bytes) -> str:
+    """无填充的base64url编码（JWT分段格式）"""
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
 
 # HTTP Bearer token scheme
 security = HTTPBearer()
+# 可选认证使用不抛异常的实例，匿名请求不再走异常控制流
+security_optional = HTTPBearer(auto_error=False)
 
 class AuthManager:
     """认证管理器"""
@@ -25,16 +55,50 @@ class AuthManager:
         self.secret_key = settings.jwt_secret_key
         self.algorithm = settings.jwt_algorithm
         self.expire_minutes = settings.jwt_access_token_expire_minutes
-    
+        self.expire_seconds = self.expire_minutes * 60
+        # 预计算JWT头部分段和密钥字节，匿名签发热路径直接复用
+        self._secret_bytes = self.secret_key.encode()
+        self._header_b64 = _b64url(
+            json.dumps({"alg": self.algorithm, "typ": "JWT"}, separators=(",", ":")).encode()
+        )
+
+    def mint_anonymous_token(self, user_id: str) -> str:
+        """为匿名用户签发访问令牌
+
+        匿名登录是高频路径，payload结构固定，直接拼装HS256 JWT
+        （预计算的头部 + base64url payload + HMAC签名），跳过JWT库的
+        通用encode路径。
+        """
+        if self.algorithm != "HS256":
+            return self.create_access_token({
+                "sub": user_id,
+                "email": None,
+                "is_anonymous": True
+            })
+
+        payload = {
+            "sub": user_id,
+            "email": None,
+            "is_anonymous": True,
+            "exp": int(time.time()) + self.expire_seconds
+        }
+        payload_b64 = _b64url(json.dumps(payload, separators=(",", ":")).encode())
+        signing_input = f"{self._header_b64}.{payload_b64}"
+        signature = hmac.new(self._secret_bytes, signing_input.encode(), hashlib.sha256).digest()
+        return f"{signing_input}.{_b64url(signature)}"
+
     def create_access_token(self, data: Dict[str, Any]) -> str:
-        """创建访问令牌"""
-        to_encode = data.copy()
-        expire = datetime.utcnow() + timedelta(minutes=self.expire_minutes)
-        to_encode.update({"exp": expire})
-        
+        """创建访问令牌
+
+        注意：直接在传入的dict上写入exp（调用方构造的都是一次性dict），
+        省去每次签发token的dict拷贝。
+        """
+        # 直接写入整数时间戳，省去datetime对象的构造与序列化
+        data["exp"] = int(time.time()) + self.expire_seconds
+
         try:
-            encoded_jwt = jwt.encode(to_encode, self.secret_key, algorithm=self.algorithm)
-            logger.info(f"为用户 {data.get('sub')} 创建访问令牌")
+            encoded_jwt = jwt.encode(data, self.secret_key, algorithm=self.algorithm)
+            logger.debug("为用户 %s 创建访问令牌", data.get("sub"))
             return encoded_jwt
         except Exception as e:
             logger.error(f"创建访问令牌失败: {e}")
@@ -45,6 +109,12 @@ class AuthManager:
     
     def verify_token(self, token: str) -> Dict[str, Any]:
         """验证令牌"""
+        # 短时间内重复出现的token直接命中缓存，跳过解码
+        now = time.monotonic()
+        cached = _token_cache.get(token)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
         try:
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
             user_id: str = payload.get("sub")
@@ -54,6 +124,7 @@ class AuthManager:
                     detail="无效的认证凭据",
                     headers={"WWW-Authenticate": "Bearer"},
                 )
+            self._cache_token(token, payload, now)
             return payload
         except JWTError as e:
             logger.error(f"Token验证失败: {e}")
@@ -63,20 +134,39 @@ class AuthManager:
                 headers={"WWW-Authenticate": "Bearer"},
             )
     
-    def hash_password(self, password: str) -> str:
-        """哈希密码"""
-        return pwd_context.hash(password)
-    
-    def verify_password(self, plain_password: str, hashed_password: str) -> bool:
-        """验证密码"""
-        return pwd_context.verify(plain_password, hashed_password)
+    @staticmethod
+    def _cache_token(token: str, payload: Dict[str, Any], now: float):
+        """缓存已验证的token payload"""
+        # 缓存有效期不超过token本身的剩余有效期
+        ttl = _TOKEN_CACHE_TTL_SECONDS
+        exp = payload.get("exp")
+        if exp is not None:
+            ttl = min(ttl, exp - time.time())
+        if ttl <= 0:
+            return
+
+        _token_cache[token] = (payload, now + ttl)
+
+        # 定期清理过期条目，防止缓存无限增长
+        if len(_token_cache) % _TOKEN_CACHE_SWEEP_INTERVAL == 0:
+            expired = [key for key, (_, deadline) in _token_cache.items() if deadline <= now]
+            for key in expired:
+                del _token_cache[key]
+
+    async def hash_password(self, password: str) -> str:
+        """哈希密码（在线程池中执行，避免bcrypt阻塞事件循环）"""
+        return await asyncio.to_thread(pwd_context.hash, password)
+
+    async def verify_password(self, plain_password: str, hashed_password: str) -> bool:
+        """验证密码（在线程池中执行，避免bcrypt阻塞事件循环）"""
+        return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
     
     async def authenticate_supabase_user(self, token: str) -> Dict[str, Any]:
         """通过Supabase认证用户"""
         try:
             # 使用Supabase客户端验证用户
-            client = db_client.get_client()
-            user_response = client.auth.get_user(token)
+            client = await db_client.get_client()
+            user_response = await client.auth.get_user(token)
             
             if user_response.user:
                 return {
@@ -98,15 +188,16 @@ class AuthManager:
     
     def create_anonymous_user(self) -> Dict[str, Any]:
         """创建匿名用户"""
-        user_id = str(uuid.uuid4())
+        # token_hex比uuid4快：跳过UUID对象构造和连字符格式化
+        user_id = secrets.token_hex(16)
         user_data = {
             "id": user_id,
             "email": None,
             "is_anonymous": True,
-            "created_at": datetime.utcnow().isoformat()
+            "created_at": iso_now()
         }
         
-        logger.info(f"创建匿名用户: {user_id}")
+        logger.info("创建匿名用户: %s", user_id)
         return user_data
 
 # 创建全局认证管理器实例
@@ -119,30 +210,19 @@ async def get_current_user(
     """获取当前用户信息"""
     token = credentials.credentials
     payload = auth_manager.verify_token(token)
-    
-    # 如果是匿名用户，直接返回payload中的信息
-    if payload.get("is_anonymous"):
-        return {
-            "id": payload.get("sub"),
-            "email": None,
-            "is_anonymous": True
-        }
-    
-    # 如果是Supabase用户，可以进一步验证
+
+    # 匿名与Supabase用户的字段一致，合并为单一返回路径
     return {
-        "id": payload.get("sub"),
+        "id": payload["sub"],
         "email": payload.get("email"),
-        "is_anonymous": False
+        "is_anonymous": payload.get("is_anonymous", False)
     }
 
 async def get_optional_user(
-    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security)
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(security_optional)
 ) -> Optional[Dict[str, Any]]:
     """获取可选的用户信息（允许匿名访问）"""
-    if not credentials:
+    if credentials is None:
         return None
-    
-    try:
-        return await get_current_user(credentials)
-    except HTTPException:
-        return None
\ No newline at end of file
+
+    return await get_current_user(credentials)
\ No newline at end of file
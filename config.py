@@ -1,4 +1,5 @@
 import os
+from functools import lru_cache
 from typing import Optional
 from pydantic_settings import BaseSettings
 
@@ -17,6 +18,11 @@ class Settings(BaseSettings):
     # JWT配置
     jwt_secret_key: str = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
     jwt_algorithm: str = "HS256"
+    # 使用PyJWT（原生加速的HMAC热路径）；关闭则回退到python-jose
+    jwt_use_pyjwt: bool = os.getenv("JWT_USE_PYJWT", "True").lower() == "true"
+
+    # 密码哈希配置
+    bcrypt_rounds: int = int(os.getenv("BCRYPT_ROUNDS", "10"))
     jwt_access_token_expire_minutes: int = int(os.getenv("JWT_ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
     
     # 应用配置
@@ -32,6 +38,7 @@ class Settings(BaseSettings):
 settings = Settings()
 
 # 验证必要的环境变量
+@lru_cache(maxsize=1)
 def validate_settings():
     """验证必要的环境变量是否已设置"""
     required_vars = [
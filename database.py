@@ -1,59 +1,96 @@
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient
 from typing import Optional, List, Dict, Any
 from config import settings
 import logging
+import time
 from models import ChatMessage, MessageRole
-from datetime import datetime
+from utils import iso_now
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 近期已确认存在的用户缓存: user_id -> 缓存过期时间戳
+# 避免每条聊天消息都触发一次Supabase往返
+_user_exists: Dict[str, float] = {}
+_USER_EXISTS_TTL_SECONDS = 300
+_USER_EXISTS_MAX_ENTRIES = 10000
+
 class SupabaseClient:
     """Supabase数据库客户端"""
     
     def __init__(self):
-        self.client: Optional[Client] = None
-        self._initialize_client()
-    
-    def _initialize_client(self):
-        """初始化Supabase客户端"""
+        self.client: Optional[AsyncClient] = None
+        self._users_table = None
+        self._messages_table = None
+
+    async def initialize(self):
+        """初始化Supabase异步客户端（在应用启动时调用）"""
+        if self.client is not None:
+            return
+
         try:
             # 使用服务角色密钥来绕过RLS策略
             supabase_key = settings.supabase_service_role_key or settings.supabase_key
-            self.client = create_client(
+            self.client = await acreate_client(
                 supabase_url=settings.supabase_url,
                 supabase_key=supabase_key
             )
+            # 复用table构建器，省去每次查询重建的分配
+            self._users_table = self.client.table("users")
+            self._messages_table = self.client.table("chat_messages")
             logger.info("Supabase客户端初始化成功")
         except Exception as e:
             logger.error(f"Supabase客户端初始化失败: {e}")
             raise
     
+    async def warm_up(self):
+        """预热到Supabase的HTTP连接池
+
+        启动时发一个轻量查询，把TCP+TLS握手挪到请求路径之外；
+        之后的请求复用keep-alive连接。失败只记警告，不阻塞启动。
+        """
+        try:
+            await self.get_client()
+            await self._users_table.select("id").limit(1).execute()
+            logger.info("数据库连接预热完成")
+        except Exception as e:
+            logger.warning(f"数据库连接预热失败: {e}")
+
     async def ensure_user_exists(self, user_id: str, email: Optional[str] = None, is_anonymous: bool = False) -> Dict[str, Any]:
         """确保用户存在，如果不存在则创建"""
+        # 短时间内刚确认过的用户直接命中缓存
+        if time.monotonic() < _user_exists.get(user_id, 0):
+            return {"id": user_id}
+
         try:
-            # 首先检查用户是否存在
-            result = self.client.table("users").select("*").eq("id", user_id).execute()
-            
-            if result.data:
-                return result.data[0]
-            
-            # 用户不存在，创建新用户
+            await self.get_client()  # 确保客户端已初始化
             user_data = {
                 "id": user_id,
                 "email": email,
                 "is_anonymous": is_anonymous,
-                "created_at": datetime.utcnow().isoformat()
+                "created_at": iso_now()
             }
-            
-            result = self.client.table("users").insert(user_data).execute()
-            
-            if result.data:
-                logger.info(f"用户创建成功，ID: {user_id}")
-                return result.data[0]
-            else:
-                raise Exception("用户创建失败，未返回数据")
-                
+
+            # 幂等upsert：一次往返完成"存在则跳过、不存在则创建"
+            # returning="minimal"让数据库不回传行数据，减少网络字节和JSON解析
+            await (
+                self._users_table
+                .upsert(
+                    user_data,
+                    on_conflict="id",
+                    ignore_duplicates=True,
+                    returning="minimal",
+                )
+                .execute()
+            )
+
+            # 简单限容，防止缓存无限增长
+            if len(_user_exists) > _USER_EXISTS_MAX_ENTRIES:
+                _user_exists.clear()
+            _user_exists[user_id] = time.monotonic() + _USER_EXISTS_TTL_SECONDS
+
+            return user_data
+
         except Exception as e:
             logger.error(f"确保用户存在失败: {e}")
             raise
@@ -68,21 +105,24 @@ class SupabaseClient:
     ) -> Dict[str, Any]:
         """创建聊天消息"""
         try:
+            await self.get_client()  # 确保客户端已初始化
+
             # 确保用户存在
             await self.ensure_user_exists(user_id, is_anonymous=is_anonymous)
-            
+
             message_data = {
                 "user_id": user_id,
                 "role": role.value,
                 "content": content,
                 "conversation_id": conversation_id,
-                "created_at": datetime.utcnow().isoformat()
+                "created_at": iso_now()
             }
-            
-            result = self.client.table("chat_messages").insert(message_data).execute()
+
+            result = await self._messages_table.insert(message_data).execute()
             
             if result.data:
-                logger.info(f"消息创建成功，ID: {result.data[0]['id']}")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("消息创建成功，ID: %s", result.data[0]["id"])
                 return result.data[0]
             else:
                 raise Exception("消息创建失败，未返回数据")
@@ -91,6 +131,49 @@ class SupabaseClient:
             logger.error(f"创建聊天消息失败: {e}")
             raise
     
+    async def create_chat_messages_batch(
+        self,
+        user_id: str,
+        messages: List[tuple],
+        conversation_id: Optional[str] = None,
+        is_anonymous: bool = False
+    ) -> List[Dict[str, Any]]:
+        """批量创建聊天消息
+
+        接收(role, content)元组列表，单次往返插入多行，
+        比逐条insert少一次网络往返。返回的行与传入顺序一致。
+        """
+        try:
+            await self.get_client()  # 确保客户端已初始化
+
+            # 确保用户存在
+            await self.ensure_user_exists(user_id, is_anonymous=is_anonymous)
+
+            created_at = iso_now()
+            rows = [
+                {
+                    "user_id": user_id,
+                    "role": role.value,
+                    "content": content,
+                    "conversation_id": conversation_id,
+                    "created_at": created_at
+                }
+                for role, content in messages
+            ]
+
+            result = await self._messages_table.insert(rows).execute()
+
+            if result.data:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("批量创建 %d 条消息成功", len(result.data))
+                return result.data
+            else:
+                raise Exception("消息批量创建失败，未返回数据")
+
+        except Exception as e:
+            logger.error(f"批量创建聊天消息失败: {e}")
+            raise
+
     async def get_conversation_history(
         self, 
         user_id: str, 
@@ -99,17 +182,21 @@ class SupabaseClient:
     ) -> List[Dict[str, Any]]:
         """获取对话历史"""
         try:
-            result = (
-                self.client.table("chat_messages")
+            await self.get_client()  # 确保客户端已初始化
+            result = await (
+                self._messages_table
                 .select("*")
                 .eq("user_id", user_id)
                 .eq("conversation_id", conversation_id)
                 .order("created_at", desc=False)
+                # created_at按秒缓存，批量写入的行时间戳相同，用id决出确定顺序
+                .order("id", desc=False)
                 .limit(limit)
                 .execute()
             )
             
-            logger.info(f"获取到 {len(result.data)} 条对话历史")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("获取到 %d 条对话历史", len(result.data))
             return result.data
             
         except Exception as e:
@@ -121,32 +208,42 @@ class SupabaseClient:
         user_id: str, 
         limit: int = 20
     ) -> List[Dict[str, Any]]:
-        """获取用户的所有对话列表"""
+        """获取用户的所有对话列表
+
+        分组聚合在Postgres端完成，每个对话只返回一行，依赖如下RPC函数::
+
+            create or replace function get_user_conversations(uid uuid, lim int)
+            returns table (conversation_id text, content text, created_at timestamptz)
+            language sql stable as $$
+                select distinct on (conversation_id)
+                       conversation_id, content, created_at
+                from chat_messages
+                where user_id = uid and role = 'user'
+                order by conversation_id, created_at desc, id desc
+                limit lim
+            $$;
+        """
         try:
-            result = (
-                self.client.table("chat_messages")
-                .select("conversation_id, created_at, content")
-                .eq("user_id", user_id)
-                .eq("role", "user")
-                .order("created_at", desc=True)
-                .limit(limit)
-                .execute()
-            )
-            
-            # 按conversation_id分组，获取每个对话的最新消息
-            conversations = {}
-            for msg in result.data:
-                conv_id = msg["conversation_id"]
-                if conv_id and conv_id not in conversations:
-                    conversations[conv_id] = {
-                        "conversation_id": conv_id,
-                        "last_message": msg["content"][:100] + "..." if len(msg["content"]) > 100 else msg["content"],
-                        "last_updated": msg["created_at"]
-                    }
-            
-            logger.info(f"获取到 {len(conversations)} 个对话")
-            return list(conversations.values())
-            
+            client = await self.get_client()
+            result = await client.rpc(
+                "get_user_conversations",
+                {"uid": user_id, "lim": limit}
+            ).execute()
+
+            conversations = [
+                {
+                    "conversation_id": row["conversation_id"],
+                    "last_message": row["content"][:100] + "..." if len(row["content"]) > 100 else row["content"],
+                    "last_updated": row["created_at"]
+                }
+                for row in result.data
+                if row["conversation_id"]
+            ]
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("获取到 %d 个对话", len(conversations))
+            return conversations
+
         except Exception as e:
             logger.error(f"获取用户对话列表失败: {e}")
             raise
@@ -158,25 +255,25 @@ class SupabaseClient:
     ) -> bool:
         """删除对话"""
         try:
-            result = (
-                self.client.table("chat_messages")
+            await self.get_client()  # 确保客户端已初始化
+            result = await (
+                self._messages_table
                 .delete()
                 .eq("user_id", user_id)
                 .eq("conversation_id", conversation_id)
                 .execute()
             )
-            
-            logger.info(f"对话 {conversation_id} 删除成功")
+
             return True
             
         except Exception as e:
             logger.error(f"删除对话失败: {e}")
             raise
     
-    def get_client(self) -> Client:
+    async def get_client(self) -> AsyncClient:
         """获取Supabase客户端实例"""
-        if not self.client:
-            self._initialize_client()
+        if self.client is None:
+            await self.initialize()
         return self.client
 
 # 创建全局数据库客户端实例
@@ -1,11 +1,15 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 from config import validate_settings
+from database import db_client
 from routers import auth_router, chat_router
 from routers.notifications import router as notifications_router
+from services import deepseek_service
 import logging
 import os
+import re
 import uvicorn
 from typing import List
 
@@ -33,24 +37,41 @@ except ValueError as e:
 app = FastAPI(
     title="AI Language Learning App",
     description="A minimal AI language learning web application with chat functionality",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson在C层序列化并直接输出bytes，降低每个响应的CPU开销
+    default_response_class=ORJSONResponse
 )
 
 # 配置CORS
+# 预编译Vercel域名正则，避免热路径上重复编译
+VERCEL_ORIGIN_RE = re.compile(r"https://.*\.vercel\.app")
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
-        "http://localhost:3000", 
-        "http://127.0.0.1:3000", 
-        "http://localhost:3001", 
+        "http://localhost:3000",
+        "http://127.0.0.1:3000",
+        "http://localhost:3001",
         "http://127.0.0.1:3001",  # 本地开发服务器
     ],
-    allow_origin_regex=r"https://.*\.vercel\.app",  # 允许所有 Vercel 域名
+    allow_origin_regex=VERCEL_ORIGIN_RE.pattern,  # 允许所有 Vercel 域名
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    # 枚举实际用到的方法和请求头，预检时做集合匹配而非通配展开
+    allow_methods=["GET", "POST", "OPTIONS", "DELETE"],
+    allow_headers=["authorization", "content-type"],
 )
 
+# 应用启动时初始化异步Supabase客户端，复用keep-alive连接
+@app.on_event("startup")
+async def startup_event():
+    await db_client.initialize()
+    # 预热连接池，首个请求不再支付TCP+TLS握手
+    await db_client.warm_up()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await deepseek_service.close()
+
 # 注册路由器
 app.include_router(auth_router, prefix="/api")
 app.include_router(chat_router, prefix="/api")
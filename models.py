@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List
 from datetime import datetime
 from enum import Enum
@@ -11,15 +11,15 @@ class MessageRole(str, Enum):
 
 class ChatMessage(BaseModel):
     """聊天消息模型"""
+    # Pydantic v2配置形式，走pydantic-core的Rust校验/序列化路径
+    model_config = ConfigDict(use_enum_values=True)
+
     id: Optional[int] = None
     user_id: str
     role: MessageRole
     content: str
     conversation_id: Optional[str] = None
     created_at: Optional[datetime] = None
-    
-    class Config:
-        use_enum_values = True
 
 class ChatMessageCreate(BaseModel):
     """创建聊天消息的请求模型"""
@@ -28,14 +28,13 @@ class ChatMessageCreate(BaseModel):
 
 class ChatMessageResponse(BaseModel):
     """聊天消息响应模型"""
+    model_config = ConfigDict(use_enum_values=True)
+
     id: int
     role: MessageRole
     content: str
     conversation_id: Optional[str]
     created_at: datetime
-    
-    class Config:
-        use_enum_values = True
 
 class ConversationHistory(BaseModel):
     """对话历史模型"""
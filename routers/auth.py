@@ -35,15 +35,9 @@ async def login(request: LoginRequest):
     """用户登录"""
     try:
         if request.anonymous:
-            # 匿名登录
+            # 匿名登录（走专用的快速签发路径）
             user_data = auth_manager.create_anonymous_user()
-            token_data = {
-                "sub": user_data["id"],
-                "email": None,
-                "is_anonymous": True
-            }
-            
-            access_token = auth_manager.create_access_token(token_data)
+            access_token = auth_manager.mint_anonymous_token(user_data["id"])
             
             return TokenResponse(
                 access_token=access_token,
@@ -1,17 +1,18 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, BackgroundTasks, HTTPException, status, Depends
 from fastapi.responses import StreamingResponse
 from typing import List, Optional
 from auth import get_current_user
 from database import get_db_client
-from services import get_deepseek_service
+from services import deepseek_service, get_deepseek_service
 from models import (
     ChatRequest, ChatResponse, ChatMessageResponse, 
     ConversationHistory, MessageRole, ErrorResponse
 )
 from .notifications import publish_notification, NotificationType
+import asyncio
 import logging
 import uuid
-import json
+import orjson
 from datetime import datetime
 
 # 配置日志
@@ -20,9 +21,76 @@ logger = logging.getLogger(__name__)
 # 创建路由器
 router = APIRouter(prefix="/chat", tags=["聊天"])
 
+# 会话上下文的进程内缓存: (user_id, conversation_id) -> 最近的role/content消息列表
+# 同一worker上连续聊天时省去每轮的历史查询；冷进程或其他worker回退到DB
+_conv_cache: dict = {}
+_CONV_CACHE_MAX_ENTRIES = 10000
+_CONV_CONTEXT_LIMIT = 10
+
+def _remember_turn(history: list, user_content: str, assistant_content: str):
+    """把本轮对话写回会话缓存，只保留最近的上下文窗口"""
+    history.append({"role": MessageRole.USER.value, "content": user_content})
+    history.append({"role": MessageRole.ASSISTANT.value, "content": assistant_content})
+    if len(history) > _CONV_CONTEXT_LIMIT:
+        del history[:-_CONV_CONTEXT_LIMIT]
+
+async def _get_cached_history(db, user_id: str, conversation_id: str) -> list:
+    """读取会话上下文，优先命中进程内缓存"""
+    cache_key = (user_id, conversation_id)
+    history = _conv_cache.get(cache_key)
+    if history is None:
+        history_data = await db.get_conversation_history(
+            user_id=user_id,
+            conversation_id=conversation_id,
+            limit=_CONV_CONTEXT_LIMIT
+        )
+        history = [
+            {"role": msg["role"], "content": msg["content"]}
+            for msg in history_data
+        ]
+        if len(_conv_cache) > _CONV_CACHE_MAX_ENTRIES:
+            _conv_cache.clear()
+        _conv_cache[cache_key] = history
+    return history
+
+# 发送给模型的提示词近似token预算（约4字符折算1个token）
+_PROMPT_TOKEN_BUDGET = 2000
+
+def _fit_to_budget(messages: list, max_tokens: int = _PROMPT_TOKEN_BUDGET) -> list:
+    """按近似token预算截断消息列表
+
+    从最新消息往前保留直到预算用尽，避免单条超长历史把prefill成本
+    和费用推高；系统提示固定保留在首位，最新的用户消息永远保留。
+    """
+    system, rest = messages[0], messages[1:]
+    budget = max_tokens - len(system["content"]) // 4
+
+    kept = []
+    for msg in reversed(rest):
+        cost = len(msg["content"]) // 4 + 1
+        if cost > budget:
+            break
+        budget -= cost
+        kept.append(msg)
+
+    if not kept and rest:
+        kept.append(rest[-1])
+
+    kept.reverse()
+    return [system] + kept
+
+# 流式分片的SSE字节模板：每个分片只有content变化，其余部分复用
+_SSE_CHUNK_PREFIX = b'data: {"finished": false, "content": '
+_SSE_CHUNK_SUFFIX = b'}\n\n'
+
+# 模块级系统提示：逐字节一致且始终作为消息前缀，
+# 让DeepSeek/OpenAI服务端的prompt前缀缓存在每一轮对话都能命中
+SYSTEM_PROMPT = deepseek_service.create_language_learning_system_prompt()
+
 @router.post("/send", response_model=ChatResponse)
 async def send_message(
     request: ChatRequest,
+    background_tasks: BackgroundTasks,
     current_user: dict = Depends(get_current_user)
 ):
     """发送聊天消息"""
@@ -33,46 +101,24 @@ async def send_message(
         # 如果没有提供conversation_id，创建一个新的
         conversation_id = request.conversation_id or str(uuid.uuid4())
         
-        # 保存用户消息到数据库
-        user_message = await db.create_chat_message(
-            user_id=user_id,
-            role=MessageRole.USER,
-            content=request.message,
-            conversation_id=conversation_id,
-            is_anonymous=current_user.get("is_anonymous", False)
-        )
-        
-        # 获取对话历史以提供上下文
-        history_data = await db.get_conversation_history(
-            user_id=user_id,
-            conversation_id=conversation_id,
-            limit=10  # 获取最近10条消息作为上下文
-        )
-        
-        # 构建消息历史
-        messages = []
-        
-        # 添加系统提示（仅在新对话开始时）
-        if not history_data:
-            deepseek = await get_deepseek_service()
-            system_prompt = deepseek.create_language_learning_system_prompt()
-            messages.append(deepseek.create_system_message(system_prompt))
-        
-        # 添加历史消息
-        for msg in history_data:
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-        
+        # 获取对话上下文（优先命中进程内缓存；用户消息延后与AI响应一起批量写入）
+        history = await _get_cached_history(db, user_id, conversation_id)
+
+        # 构建消息历史：固定的系统提示始终在最前，保证前缀稳定
+        messages = [deepseek_service.create_system_message(SYSTEM_PROMPT)]
+        messages.extend(history)
+
         # 添加当前用户消息
         messages.append({
             "role": MessageRole.USER.value,
             "content": request.message
         })
-        
+
+        # 控制提示词在token预算内
+        messages = _fit_to_budget(messages)
+
         # 调用DeepSeek API
-        deepseek = await get_deepseek_service()
+        deepseek = get_deepseek_service()
         ai_response = await deepseek.generate_response(
             messages=messages,
             model=request.model,
@@ -82,26 +128,31 @@ async def send_message(
         
         ai_response_content = ai_response["content"]
         tokens_used = ai_response["usage"]["total_tokens"]
-        
-        # 保存AI响应到数据库
-        ai_message = await db.create_chat_message(
+
+        # 用户消息和AI响应合并为一次批量写入，省一次DB往返
+        user_message, ai_message = await db.create_chat_messages_batch(
             user_id=user_id,
-            role=MessageRole.ASSISTANT,
-            content=ai_response_content,
+            messages=[
+                (MessageRole.USER, request.message),
+                (MessageRole.ASSISTANT, ai_response_content)
+            ],
             conversation_id=conversation_id,
             is_anonymous=current_user.get("is_anonymous", False)
         )
-        
-        # 发布新消息通知
-        await publish_notification(
+
+        # 本轮对话写回上下文缓存
+        _remember_turn(history, request.message, ai_response_content)
+
+        # 发布新消息通知（响应返回后由BackgroundTasks执行，不阻塞响应）
+        background_tasks.add_task(
+            publish_notification,
             event_type=NotificationType.MESSAGE_RECEIVED,
-            title="收到新回复",
-            message=f"AI助手回复了您的消息",
-            metadata={
+            data={
                 "conversation_id": conversation_id,
-                "message_id": ai_message["id"],
-                "user_id": user_id
-            }
+                "message_id": ai_message["id"]
+            },
+            user_id=user_id,
+            conversation_id=conversation_id
         )
         
         return ChatResponse(
@@ -133,43 +184,33 @@ async def send_message_stream(
         # 如果没有提供conversation_id，创建一个新的
         conversation_id = request.conversation_id or str(uuid.uuid4())
         
-        # 保存用户消息到数据库
-        user_message = await db.create_chat_message(
+        # 先读对话上下文（优先命中进程内缓存）：缓存未命中时的历史查询
+        # 必须先于用户消息写入，否则刚插入的行会混进历史造成重复
+        history = await _get_cached_history(db, user_id, conversation_id)
+
+        # 用户消息的写入与LLM流式调用并行，完成帧前再取写入结果
+        user_message_task = asyncio.create_task(db.create_chat_message(
             user_id=user_id,
             role=MessageRole.USER,
             content=request.message,
             conversation_id=conversation_id
-        )
-        
-        # 获取对话历史
-        history_data = await db.get_conversation_history(
-            user_id=user_id,
-            conversation_id=conversation_id,
-            limit=10
-        )
-        
-        # 构建消息历史
-        messages = []
-        
-        if not history_data:
-            deepseek = await get_deepseek_service()
-            system_prompt = deepseek.create_language_learning_system_prompt()
-            messages.append(deepseek.create_system_message(system_prompt))
-        
-        for msg in history_data:
-            messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-        
+        ))
+
+        # 构建消息历史：固定的系统提示始终在最前，保证前缀稳定
+        messages = [deepseek_service.create_system_message(SYSTEM_PROMPT)]
+        messages.extend(history)
+
         messages.append({
             "role": MessageRole.USER.value,
             "content": request.message
         })
-        
+
+        # 控制提示词在token预算内
+        messages = _fit_to_budget(messages)
+
         # 流式响应生成器
         async def generate_stream():
-            deepseek = await get_deepseek_service()
+            deepseek = get_deepseek_service()
             full_content = ""
             
             async for chunk in deepseek.generate_streaming_response(
@@ -179,11 +220,12 @@ async def send_message_stream(
                 max_tokens=request.max_tokens
             ):
                 if "error" in chunk:
-                    yield f"data: {json.dumps({'error': chunk['error']})}\n\n"
+                    yield b"data: " + orjson.dumps({"error": chunk["error"]}) + b"\n\n"
                     break
-                
+
                 if chunk["finished"]:
                     full_content = chunk["full_content"]
+                    user_message = await user_message_task
                     # 保存完整的AI响应到数据库
                     ai_message = await db.create_chat_message(
                         user_id=user_id,
@@ -192,26 +234,38 @@ async def send_message_stream(
                         conversation_id=conversation_id,
                         is_anonymous=current_user.get("is_anonymous", False)
                     )
-                    
-                    yield f"data: {json.dumps({
-                        'finished': True,
-                        'conversation_id': conversation_id,
-                        'user_message_id': user_message['id'],
-                        'assistant_message_id': ai_message['id']
-                    })}\n\n"
+
+                    # 本轮对话写回上下文缓存
+                    _remember_turn(history, request.message, full_content)
+
+                    yield b"data: " + orjson.dumps({
+                        "finished": True,
+                        "conversation_id": conversation_id,
+                        "user_message_id": user_message["id"],
+                        "assistant_message_id": ai_message["id"]
+                    }) + b"\n\n"
+
+                    # 完成帧已发出，通知在后台发布
+                    asyncio.create_task(publish_notification(
+                        event_type=NotificationType.MESSAGE_RECEIVED,
+                        data={
+                            "conversation_id": conversation_id,
+                            "message_id": ai_message["id"]
+                        },
+                        user_id=user_id,
+                        conversation_id=conversation_id
+                    ))
                 else:
-                    yield f"data: {json.dumps({
-                        'content': chunk['content'],
-                        'finished': False
-                    })}\n\n"
+                    yield _SSE_CHUNK_PREFIX + orjson.dumps(chunk["content"]) + _SSE_CHUNK_SUFFIX
         
         return StreamingResponse(
             generate_stream(),
-            media_type="text/plain",
+            media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
-                "Content-Type": "text/event-stream"
+                # 关闭nginx等反向代理的缓冲，SSE分片即时送达
+                "X-Accel-Buffering": "no"
             }
         )
     
@@ -239,16 +293,20 @@ async def get_conversation_history(
             limit=limit
         )
         
-        messages = [
-            ChatMessageResponse(
+        # 局部绑定省去每行的属性查找；Python 3.11+的fromisoformat可直接解析'Z'后缀
+        fromiso = datetime.fromisoformat
+        messages = []
+        for msg in messages_data:
+            created_at = msg["created_at"]
+            if not isinstance(created_at, datetime):
+                created_at = fromiso(created_at)
+            messages.append(ChatMessageResponse(
                 id=msg["id"],
                 role=MessageRole(msg["role"]),
                 content=msg["content"],
                 conversation_id=msg["conversation_id"],
-                created_at=datetime.fromisoformat(msg["created_at"].replace('Z', '+00:00'))
-            )
-            for msg in messages_data
-        ]
+                created_at=created_at
+            ))
         
         return ConversationHistory(
             conversation_id=conversation_id,
@@ -304,7 +362,10 @@ async def delete_conversation(
             user_id=user_id,
             conversation_id=conversation_id
         )
-        
+
+        # 同步失效上下文缓存，避免已删除的对话被后续消息复活
+        _conv_cache.pop((user_id, conversation_id), None)
+
         if success:
             return {"message": "对话删除成功"}
         else:
@@ -5,9 +5,12 @@ from auth import get_current_user
 from database import get_db_client
 from models import ErrorResponse
 import logging
-import json
+import itertools
+import orjson
 import asyncio
-from datetime import datetime
+import time
+from collections import defaultdict, deque
+from datetime import datetime, timezone
 from enum import Enum
 
 # 配置日志
@@ -24,20 +27,24 @@ class NotificationType(str, Enum):
     USER_LEFT = "user_left"
     SYSTEM_NOTIFICATION = "system_notification"
 
+# 事件ID的单调后缀，保证高频发布下也不会碰撞
+_event_counter = itertools.count()
+
 class NotificationEvent:
     """通知事件模型"""
-    def __init__(self, 
-                 event_type: NotificationType, 
-                 data: Dict[Any, Any], 
+    def __init__(self,
+                 event_type: NotificationType,
+                 data: Dict[Any, Any],
                  user_id: str = None,
                  conversation_id: str = None):
         self.event_type = event_type
         self.data = data
         self.user_id = user_id
         self.conversation_id = conversation_id
-        self.timestamp = datetime.utcnow().isoformat()
-        self.event_id = f"{event_type}_{int(datetime.utcnow().timestamp() * 1000)}"
-    
+        # 只取一次纳秒时间戳，ISO格式化推迟到to_dict
+        self.timestamp_ns = time.time_ns()
+        self.event_id = f"{event_type}_{self.timestamp_ns}_{next(_event_counter)}"
+
     def to_dict(self) -> Dict[str, Any]:
         return {
             "event_id": self.event_id,
@@ -45,31 +52,43 @@ class NotificationEvent:
             "data": self.data,
             "user_id": self.user_id,
             "conversation_id": self.conversation_id,
-            "timestamp": self.timestamp
+            "timestamp": datetime.fromtimestamp(
+                self.timestamp_ns / 1e9, tz=timezone.utc
+            ).isoformat()
         }
 
 # 全局事件存储（生产环境中应使用Redis或其他消息队列）
 class EventStore:
     def __init__(self):
-        self.events: List[NotificationEvent] = []
+        # 按用户维护的事件索引，读取时无需全表过滤
+        # （不再保留全局事件总表，轮询路径已由索引和SSE覆盖）
+        self.user_events: Dict[str, deque] = defaultdict(lambda: deque(maxlen=50))
+        self.global_events: deque = deque(maxlen=50)
         self.subscribers: Dict[str, List[asyncio.Queue]] = {}
-    
+
     async def publish_event(self, event: NotificationEvent):
         """发布事件到所有订阅者"""
-        self.events.append(event)
-        
-        # 保持最近1000个事件
-        if len(self.events) > 1000:
-            self.events = self.events[-1000:]
-        
-        # 通知订阅者
+        # 写入按用户的索引
+        if event.user_id is None:
+            self.global_events.append(event)
+        else:
+            self.user_events[event.user_id].append(event)
+
+        # 通知订阅者（非阻塞投递：慢消费者不拖住发布方和其他订阅者）
         user_id = event.user_id or "global"
         if user_id in self.subscribers:
+            slow_queues = []
             for queue in self.subscribers[user_id]:
                 try:
-                    await queue.put(event)
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    logger.warning("订阅者队列已满，丢弃事件并移除慢订阅者: %s", user_id)
+                    slow_queues.append(queue)
                 except Exception as e:
                     logger.error(f"Failed to notify subscriber: {e}")
+
+            for queue in slow_queues:
+                self.unsubscribe(user_id, queue)
     
     def subscribe(self, user_id: str) -> asyncio.Queue:
         """订阅用户事件"""
@@ -92,18 +111,22 @@ class EventStore:
     
     def get_recent_events(self, user_id: str, limit: int = 50) -> List[NotificationEvent]:
         """获取最近的事件"""
-        user_events = [e for e in self.events if e.user_id == user_id or e.user_id is None]
-        return user_events[-limit:]
+        # 直接读取按用户索引，O(limit)而非遍历全部事件
+        user_events = self.user_events.get(user_id)
+        merged = list(user_events) if user_events else []
+        merged.extend(self.global_events)
+        merged.sort(key=lambda e: e.timestamp_ns)
+        return merged[-limit:]
 
 # 全局事件存储实例
 event_store = EventStore()
 
-@router.get("/recent")
+@router.get("/recent", deprecated=True)
 async def get_recent_notifications(
     limit: int = 50,
     current_user: dict = Depends(get_current_user)
 ):
-    """获取最近的通知事件（轮询方式）"""
+    """获取最近的通知事件（轮询方式，已废弃：请改用 /stream SSE端点）"""
     try:
         user_id = current_user["id"]
         events = event_store.get_recent_events(user_id, limit)
@@ -131,17 +154,16 @@ async def stream_notifications(
         queue = event_store.subscribe(user_id)
         try:
             # 发送连接确认
-            yield f"data: {json.dumps({'type': 'connected', 'user_id': user_id})}\n\n"
+            yield b"data: " + orjson.dumps({"type": "connected", "user_id": user_id}) + b"\n\n"
             
             while True:
                 try:
                     # 等待新事件，设置超时以发送心跳
                     event = await asyncio.wait_for(queue.get(), timeout=30.0)
-                    event_data = json.dumps(event.to_dict())
-                    yield f"data: {event_data}\n\n"
+                    yield b"data: " + orjson.dumps(event.to_dict()) + b"\n\n"
                 except asyncio.TimeoutError:
                     # 发送心跳
-                    yield f"data: {json.dumps({'type': 'heartbeat', 'timestamp': datetime.utcnow().isoformat()})}\n\n"
+                    yield b"data: " + orjson.dumps({"type": "heartbeat", "timestamp": datetime.utcnow().isoformat()}) + b"\n\n"
                 except Exception as e:
                     logger.error(f"SSE stream error: {e}")
                     break
@@ -1,32 +1,86 @@
+import httpx
 import openai
 from typing import List, Dict, Any, Optional
 from config import settings
 from models import MessageRole
+import hashlib
+import json
 import logging
+from functools import lru_cache
 import asyncio
+import time
 from datetime import datetime
 
 # 配置日志
 logger = logging.getLogger(__name__)
 
+# 相同请求（消息+采样参数）的进程内响应缓存: key -> (响应, 过期时间戳)
+# 命中时完全跳过API往返，也不消耗token
+_response_cache: Dict[str, tuple] = {}
+_RESPONSE_CACHE_TTL_DETERMINISTIC = 300   # temperature == 0，结果确定，可长缓存
+_RESPONSE_CACHE_TTL_SAMPLED = 30          # temperature > 0，只做短时间去重
+_RESPONSE_CACHE_MAX_ENTRIES = 1000
+
+# 角色名到OpenAI API规范值的查表映射，未知角色按用户消息处理
+_VALID_ROLES = frozenset((
+    MessageRole.USER.value,
+    MessageRole.ASSISTANT.value,
+    MessageRole.SYSTEM.value
+))
+
+def _response_cache_key(
+    messages: List[Dict[str, str]],
+    model: str,
+    temperature: float,
+    max_tokens: int
+) -> str:
+    """按归一化的请求参数生成缓存键"""
+    raw = json.dumps(
+        {
+            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "messages": messages
+        },
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
+
 class DeepSeekService:
     """DeepSeek API服务类"""
     
     def __init__(self):
         self.client = None
+        self._http_client = None
         self._initialize_client()
-    
+
     def _initialize_client(self):
         """初始化OpenAI客户端（用于DeepSeek API）"""
         try:
+            # HTTP/2让并发的流式请求复用同一条TCP/TLS连接，
+            # 扩大连接池上限以避免高并发下的队头阻塞
+            self._http_client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                timeout=httpx.Timeout(60.0, connect=5.0)
+            )
             self.client = openai.AsyncOpenAI(
                 api_key=settings.deepseek_api_key,
-                base_url=settings.deepseek_base_url
+                base_url=settings.deepseek_base_url,
+                http_client=self._http_client
             )
             logger.info("DeepSeek客户端初始化成功")
         except Exception as e:
             logger.error(f"DeepSeek客户端初始化失败: {e}")
             raise
+
+    async def close(self):
+        """关闭底层HTTP客户端（应用关闭时调用）"""
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+            self.client = None
     
     async def generate_response(
         self,
@@ -43,9 +97,20 @@ class DeepSeekService:
             
             # 确保消息格式正确
             formatted_messages = self._format_messages(messages)
-            
+
+            # 相同请求短时间内直接命中缓存（流式响应不缓存）
+            cache_key = None
+            if not stream:
+                cache_key = _response_cache_key(
+                    formatted_messages, model, temperature, max_tokens
+                )
+                cached = _response_cache.get(cache_key)
+                if cached is not None and cached[1] > time.monotonic():
+                    logger.debug("DeepSeek响应缓存命中")
+                    return cached[0]
+
             logger.info(f"发送请求到DeepSeek API，消息数量: {len(formatted_messages)}")
-            
+
             response = await self.client.chat.completions.create(
                 model=model,
                 messages=formatted_messages,
@@ -70,6 +135,17 @@ class DeepSeekService:
                 }
                 
                 logger.info(f"DeepSeek API响应成功，使用tokens: {result['usage']['total_tokens']}")
+
+                if cache_key is not None:
+                    if len(_response_cache) > _RESPONSE_CACHE_MAX_ENTRIES:
+                        _response_cache.clear()
+                    ttl = (
+                        _RESPONSE_CACHE_TTL_DETERMINISTIC
+                        if temperature == 0
+                        else _RESPONSE_CACHE_TTL_SAMPLED
+                    )
+                    _response_cache[cache_key] = (result, time.monotonic() + ttl)
+
                 return result
         
         except Exception as e:
@@ -78,24 +154,18 @@ class DeepSeekService:
     
     def _format_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
         """格式化消息为OpenAI API格式"""
-        formatted = []
-        
-        for msg in messages:
-            role = msg.get("role", "user")
-            content = msg.get("content", "")
-            
-            # 确保角色名称符合OpenAI API规范
-            if role == MessageRole.USER.value:
-                formatted.append({"role": "user", "content": content})
-            elif role == MessageRole.ASSISTANT.value:
-                formatted.append({"role": "assistant", "content": content})
-            elif role == MessageRole.SYSTEM.value:
-                formatted.append({"role": "system", "content": content})
-            else:
-                # 默认作为用户消息处理
-                formatted.append({"role": "user", "content": content})
-        
-        return formatted
+        # 常见情况（routers/chat.py构造的消息）角色已经规范，直接复用原列表
+        if all(msg.get("role") in _VALID_ROLES for msg in messages):
+            return messages
+
+        # 非规范角色按用户消息处理
+        return [
+            {
+                "role": msg["role"] if msg.get("role") in _VALID_ROLES else "user",
+                "content": msg.get("content", "")
+            }
+            for msg in messages
+        ]
     
     async def generate_streaming_response(
         self,
@@ -115,22 +185,22 @@ class DeepSeekService:
             )
             
             stream = response_data["stream"]
-            full_content = ""
-            
+            # 用list累积分片，完成时一次join，避免逐片字符串拼接的O(n²)开销
+            parts = []
+
             async for chunk in stream:
                 if chunk.choices[0].delta.content is not None:
                     content = chunk.choices[0].delta.content
-                    full_content += content
+                    parts.append(content)
                     yield {
                         "content": content,
-                        "full_content": full_content,
                         "finished": False
                     }
-            
+
             # 发送完成信号
             yield {
                 "content": "",
-                "full_content": full_content,
+                "full_content": "".join(parts),
                 "finished": True
             }
         
@@ -148,8 +218,9 @@ class DeepSeekService:
             "content": content
         }
     
+    @lru_cache(maxsize=8)
     def create_language_learning_system_prompt(self, target_language: str = "English") -> str:
-        """创建语言学习系统提示"""
+        """创建语言学习系统提示（每种目标语言只构建一次，保持字符串稳定）"""
         return f"""你是一个专业的{target_language}语言学习助手。请遵循以下指导原则：
 
 1. 根据用户的语言水平调整回答的复杂度
@@ -183,6 +254,6 @@ class DeepSeekService:
 deepseek_service = DeepSeekService()
 
 # 便捷函数
-async def get_deepseek_service() -> DeepSeekService:
+def get_deepseek_service() -> DeepSeekService:
     """获取DeepSeek服务实例"""
     return deepseek_service
\ No newline at end of file
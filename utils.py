@@ -0,0 +1,12 @@
+from datetime import datetime
+from functools import lru_cache
+import time
+
+@lru_cache(maxsize=1)
+def _iso_for_second(second: int) -> str:
+    """格式化指定秒级时间戳为ISO字符串"""
+    return datetime.utcfromtimestamp(second).isoformat()
+
+def iso_now() -> str:
+    """当前UTC时间的ISO字符串（按秒缓存，避免热路径上重复格式化）"""
+    return _iso_for_second(int(time.time()))